@@ -17,6 +17,9 @@ import asyncio
 import math
 import time
 import xml.etree.cElementTree as ET
+from collections import deque
+from functools import partial
+from threading import Event
 from threading import Thread
 
 from pynput import keyboard
@@ -58,6 +61,8 @@ controller_offset_y = 0.0 # in m
 controller_offset_z = 0.5 # in m
 cf_max_vel = 2 # in m/s
 cf_trackingLoss_treshold = 200
+cf_setpoint_period = 0.02 # in s
+qtm_stall_timeout = 0.3 # in s
 
 
 #
@@ -65,6 +70,10 @@ cf_trackingLoss_treshold = 200
 #
 
 
+# QTM reports positions in mm
+mm_to_m = 0.001
+
+
 def sqrt(x):
     """Calculate sqrt while avoiding rounding errors with slightly negative x."""
     if x < 0.0:
@@ -72,8 +81,17 @@ def sqrt(x):
     return math.sqrt(x)
 
 
+def is_valid_position(pos):
+    """Check that none of the coordinates are NaN (NaN is not equal to itself)."""
+    x, y, z = pos
+    return x == x and y == y and z == z
+
+
 class Pose:
-    """Holds pose data with euler angles and/or rotation matrix"""
+    """Holds pose data with euler angles and/or rotation matrix
+
+    The rotation matrix is stored as QTM's flat 9-tuple in column-major order.
+    """
     def __init__(self, x, y, z, roll=None, pitch=None, yaw=None, rotmatrix=None):
         self.x = x
         self.y = y
@@ -86,24 +104,20 @@ class Pose:
     @classmethod
     def from_qtm_6d(cls, qtm_6d):
         """Build pose from rigid body data in QTM 6d component"""
-        qtm_rot = qtm_6d[1].matrix
-        cf_rot = [[qtm_rot[0], qtm_rot[3], qtm_rot[6]],
-                  [qtm_rot[1], qtm_rot[4], qtm_rot[7]],
-                  [qtm_rot[2], qtm_rot[5], qtm_rot[8]]]
-        return cls(qtm_6d[0][0] / 1000,
-                   qtm_6d[0][1] / 1000,
-                   qtm_6d[0][2] / 1000,
-                   rotmatrix = cf_rot)
-
-    @classmethod
-    def from_qtm_6deuler(cls, qtm_6deuler):
-        """Build pose from rigid body data in QTM 6deuler component"""
-        return cls(qtm_6deuler[0][0] / 1000,
-                   qtm_6deuler[0][1] / 1000,
-                   qtm_6deuler[0][2] / 1000,
-                   roll  = qtm_6deuler[1][2],
-                   pitch = qtm_6deuler[1][1],
-                   yaw   = qtm_6deuler[1][0])
+        x, y, z = qtm_6d[0]
+        # Keep QTM's flat, column-major 9-tuple as is (no transposed copy)
+        return cls(x * mm_to_m,
+                   y * mm_to_m,
+                   z * mm_to_m,
+                   rotmatrix = qtm_6d[1].matrix)
+
+    def update_from_qtm_6d(self, qtm_6d):
+        """Overwrite pose in place with rigid body data in QTM 6d component"""
+        x, y, z = qtm_6d[0]
+        self.x = x * mm_to_m
+        self.y = y * mm_to_m
+        self.z = z * mm_to_m
+        self.rotmatrix = qtm_6d[1].matrix
 
     def distance_to(self, other_point):
         return sqrt(
@@ -111,10 +125,6 @@ class Pose:
             (self.y - other_point.y) ** 2 +
             (self.z - other_point.z) ** 2)
 
-    def is_valid(self):
-        """Check if any of the coodinates are NaN."""
-        return self.x == self.x and self.y == self.y and self.z == self.z
-
     def __str__(self):
         return "x: {:6.2f} y: {:6.2f} z: {:6.2f} Roll: {:6.2f} Pitch: {:6.2f} Yaw: {:6.2f}".format(
             self.x, self.y, self.z, self.roll, self.pitch, self.yaw)
@@ -127,9 +137,10 @@ class Pose:
 fly = True
 cf_trackingLoss = 0
 cf_pose = Pose(0, 0, 0)
-controller_poses = [Pose(0, 0, 0)] * len(controller_body_names)
+controller_poses = [Pose(0, 0, 0) for _ in controller_body_names]
 controller_select = 0
 land_to_target = False
+fly_abort = Event()
 
 
 #
@@ -143,24 +154,47 @@ class QtmWrapper(Thread):
         Thread.__init__(self)
 
         self.on_cf_pose = None
+        self.on_control = None
         self.connection = None
         self.bodyToIdx = {}
+        self.last_packet_t = 0.0
+        self._cf_idx = None
+        self._controller_idx = ()
+        self._last_setpoint_t = 0.0
         self._stay_open = True
+        self._loop = None
+        self._stop_event = None
 
         self.start()
 
     def close(self):
         self._stay_open = False
+        # Wake up the life cycle on the QTM thread, if it is still running
+        loop = self._loop
+        if loop is not None and self.is_alive():
+            try:
+                loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                # Loop was closed in the meantime, the thread is finishing
+                pass
         self.join()
 
     def run(self):
         asyncio.run(self._life_cycle())
 
-    async def _life_cycle(self): 
-        await self._connect()
-        while(self._stay_open):
-            await asyncio.sleep(1)
-        await self._close()
+    async def _life_cycle(self):
+        self._stop_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        # close() may have been called before the loop was published
+        if not self._stay_open:
+            self._stop_event.set()
+        try:
+            await self._connect()
+            await self._stop_event.wait()
+            await self._close()
+        finally:
+            # asyncio.run() closes the loop once we return
+            self._loop = None
 
     async def _connect(self):
         print('Connecting to QTM at ' + qtm_ip)
@@ -179,7 +213,7 @@ class QtmWrapper(Thread):
         else:
             print("Crazyflie body '" + cf_body_name + "' not found in QTM 6DOF bodies!")
             print("Aborting...")
-            self._stay_open = False
+            self._stop_event.set()
 
         for controller_body_name in controller_body_names:
             if controller_body_name in self.bodyToIdx:
@@ -187,48 +221,59 @@ class QtmWrapper(Thread):
             else:
                 print("Controller body '" + controller_body_name + "' not found in QTM 6DOF bodies!")
                 print("Aborting...")
-                self._stay_open = False
+                self._stop_event.set()
+
+        if self._stop_event.is_set():
+            return
 
-        await self.connection.stream_frames(components=['6d', '6deuler'], on_packet=self._on_packet)
+        # Resolve body indexes once instead of looking them up on every packet
+        self._cf_idx = self.bodyToIdx[cf_body_name]
+        self._controller_idx = tuple(self.bodyToIdx[name] for name in controller_body_names)
+
+        await self.connection.stream_frames(components=['6d'], on_packet=self._on_packet)
 
 
     def _on_packet(self, packet):
         global cf_pose, controller_poses, cf_trackingLoss
-        # We need the 6d component to send full pose to Crazyflie,
-        # and the 6deuler component for convenient calculations
+        on_cf_pose = self.on_cf_pose
+        # The 6d component carries the full pose for the Crazyflie,
+        # and the positions of the controllers
         header, component_6d = packet.get_6d()
-        header, component_6deuler = packet.get_6d_euler()
 
         if component_6d is None:
             print('No 6d component in QTM packet!')
             return              
-        
-        if component_6deuler is None:
-            print('No 6deuler component in QTM packet!')
-            return      
+
+        now = time.monotonic()
+        self.last_packet_t = now
 
         # Get 6DOF data for Crazyflie
-        cf_6d = component_6d[self.bodyToIdx[cf_body_name]]
-        # Store in temp until validity is checked
-        _cf_pose = Pose.from_qtm_6d(cf_6d)
-        # Check validity
-        if _cf_pose.is_valid():
+        cf_6d = component_6d[self._cf_idx]
+        # Check validity before building a pose
+        if is_valid_position(cf_6d[0]):
             # Update global var for pose
-            cf_pose = _cf_pose
+            cf_pose = Pose.from_qtm_6d(cf_6d)
             # Stream full pose to Crazyflie
-            if self.on_cf_pose:
-                self.on_cf_pose([cf_pose.x, cf_pose.y, cf_pose.z, cf_pose.rotmatrix])
+            if on_cf_pose:
+                on_cf_pose(cf_pose.x, cf_pose.y, cf_pose.z, cf_pose.rotmatrix)
                 cf_trackingLoss = 0
         else:
             cf_trackingLoss += 1
 
         # Get 6DOF data for controllers and update globals
 
-        for i, controller_body_name in enumerate(controller_body_names):
-            controller_6deuler = component_6deuler[self.bodyToIdx[controller_body_name]]
-            _controller_pose = Pose.from_qtm_6deuler(controller_6deuler)
-            if _controller_pose.is_valid():
-                controller_poses[i] = _controller_pose
+        poses = controller_poses
+        for i, controller_idx in enumerate(self._controller_idx):
+            controller_6d = component_6d[controller_idx]
+            if is_valid_position(controller_6d[0]):
+                poses[i].update_from_qtm_6d(controller_6d)
+
+        # Drive the flight controller in lockstep with new measurements
+        on_control = self.on_control
+        if on_control:
+            if now - self._last_setpoint_t >= cf_setpoint_period:
+                self._last_setpoint_t = now
+                on_control()
 
     async def _close(self):
         await self.connection.stream_frames_stop()
@@ -240,16 +285,63 @@ class QtmWrapper(Thread):
 #
 
 
+def quat_from_rot_matrix(rot):
+    """Convert flat 3x3 rotation matrix to normalized quaternion (qx, qy, qz, qw)."""
+    # Only the diagonal is used, so row- or column-major order makes no difference
+    r00 = rot[0]
+    r11 = rot[4]
+    r22 = rot[8]
+    qw = sqrt(1 + r00 + r11 + r22)
+    qx = sqrt(1 + r00 - r11 - r22)
+    qy = sqrt(1 - r00 + r11 - r22)
+    qz = sqrt(1 - r00 - r11 + r22)
+    # Normalize the quaternion (the common factor 1/2 cancels out)
+    n = 1.0 / math.sqrt(qx * qx + qy * qy + qz * qz + qw * qw)
+    return qx * n, qy * n, qz * n, qw * n
+
+
 def send_extpose_rot_matrix(cf, x, y, z, rot):
     """Send full pose from mocap to Crazyflie."""
-    qw = sqrt(1 + rot[0][0] + rot[1][1] + rot[2][2]) / 2
-    qx = sqrt(1 + rot[0][0] - rot[1][1] - rot[2][2]) / 2
-    qy = sqrt(1 - rot[0][0] + rot[1][1] - rot[2][2]) / 2
-    qz = sqrt(1 - rot[0][0] - rot[1][1] + rot[2][2]) / 2
-    # Normalize the quaternion
-    ql = math.sqrt(qx ** 2 + qy ** 2 + qz ** 2 + qw ** 2)
+    qx, qy, qz, qw = quat_from_rot_matrix(rot)
     # Send to Crazyflie
-    cf.extpos.send_extpose(x, y, z, qx / ql, qy / ql, qz / ql, qw / ql)
+    cf.extpos.send_extpose(x, y, z, qx, qy, qz, qw)
+
+
+def follow_controller(cf):
+    """Send one position setpoint towards the selected controller."""
+    if not fly or fly_abort.is_set():
+        return
+
+    # Land if drone strays out of bounding box
+    if not (x_min - safeZone_margin < cf_pose.x < x_max + safeZone_margin
+       and  y_min - safeZone_margin < cf_pose.y < y_max + safeZone_margin
+       and  z_min - safeZone_margin < cf_pose.z < z_max + safeZone_margin):
+        print("DRONE HAS LEFT SAFE ZONE!")
+        fly_abort.set()
+        return
+    # Land if drone disappears
+    if cf_trackingLoss > cf_trackingLoss_treshold:
+        print("TRACKING LOST FOR " + str(cf_trackingLoss_treshold) + " FRAMES!")
+        fly_abort.set()
+        return
+
+    # Select controller to follow
+    controller_pose = controller_poses[controller_select]
+
+    # Compute target
+    target_x = controller_pose.x + controller_offset_x
+    target_y = controller_pose.y + controller_offset_y
+    target_z = controller_pose.z + controller_offset_z
+    # Controller yaw can be derived from controller_pose.rotmatrix if needed
+    target_yaw = 0
+
+    # Keep target inside bounding box
+    target_x = x_min if target_x < x_min else x_max if target_x > x_max else target_x
+    target_y = y_min if target_y < y_min else y_max if target_y > y_max else target_y
+    target_z = z_min if target_z < z_min else z_max if target_z > z_max else target_z
+
+    # Go to target
+    cf.commander.send_position_setpoint(target_x, target_y, target_z, target_yaw)
 
 
 def setup_estimator(cf):
@@ -276,9 +368,9 @@ def setup_estimator(cf):
     log_config.add_variable('kalman.varPY', 'float')
     log_config.add_variable('kalman.varPZ', 'float')
 
-    var_y_history = [1000] * 10
-    var_x_history = [1000] * 10
-    var_z_history = [1000] * 10
+    var_y_history = deque([1000] * 10, maxlen=10)
+    var_x_history = deque([1000] * 10, maxlen=10)
+    var_z_history = deque([1000] * 10, maxlen=10)
 
     threshold = 0.001
 
@@ -287,11 +379,8 @@ def setup_estimator(cf):
             data = log_entry[1]
 
             var_x_history.append(data['kalman.varPX'])
-            var_x_history.pop(0)
             var_y_history.append(data['kalman.varPY'])
-            var_y_history.pop(0)
             var_z_history.append(data['kalman.varPZ'])
-            var_z_history.pop(0)
 
             min_x = min(var_x_history)
             max_x = max(var_x_history)
@@ -309,33 +398,50 @@ def setup_estimator(cf):
                 break
 
 
+def nudge_offset(dx=0.0, dy=0.0, dz=0.0):
+    """Adjust offset from controller."""
+    global controller_offset_x, controller_offset_y, controller_offset_z
+    controller_offset_x += dx
+    controller_offset_y += dy
+    controller_offset_z += dz
+
+
+def select_controller(index):
+    """Switch to another controller."""
+    global controller_select
+    if index < len(controller_body_names):
+        controller_select = index
+
+
+def land_on_target():
+    """Stop following and land on the current controller."""
+    global fly, land_to_target
+    land_to_target = True
+    fly = False
+
+
+key_actions = {
+    "a": lambda: nudge_offset(dx=-0.1),
+    "d": lambda: nudge_offset(dx=0.1),
+    "s": lambda: nudge_offset(dy=-0.1),
+    "w": lambda: nudge_offset(dy=0.1),
+    "z": lambda: nudge_offset(dz=-0.1),
+    "x": lambda: nudge_offset(dz=0.1),
+    "l": land_on_target,
+    "1": lambda: select_controller(0),
+    "2": lambda: select_controller(1),
+    "3": lambda: select_controller(2),
+}
+
+
 def on_press(key):
     """React to keyboard."""
-    global fly, controller_offset_x, controller_offset_y, controller_offset_z, controller_select, land_to_target
+    global fly
     if key == keyboard.Key.esc:
         fly = False
-    if hasattr(key, 'char'):
-        if key.char == "a":
-            controller_offset_x -= 0.1
-        if key.char == "d":
-            controller_offset_x += 0.1
-        if key.char == "s":
-            controller_offset_y -= 0.1
-        if key.char == "w":
-            controller_offset_y += 0.1
-        if key.char == "z":
-            controller_offset_z -= 0.1
-        if key.char == "x":
-            controller_offset_z += 0.1
-        if key.char == "l":
-            land_to_target = True
-            fly = False
-        if key.char == "1":
-            controller_select = 0
-        if key.char == "2":
-            controller_select = 1
-        if key.char == "3":
-            controller_select = 2
+    action = key_actions.get(getattr(key, 'char', None))
+    if action:
+        action()
         print("Controller: " + controller_body_names[controller_select])
         print("Offset: X: {:5.2f}  Y: {:5.2f}  Z: {:5.2f}".format(
                 controller_offset_x, controller_offset_y, controller_offset_z))
@@ -366,43 +472,25 @@ with SyncCrazyflie(cf_uri, cf=Crazyflie(rw_cache='./cache')) as scf:
 
 
     # Set up callbacks to handle data from QTM
-    qtm_wrapper.on_cf_pose = lambda pose: send_extpose_rot_matrix(cf, pose[0], pose[1], pose[2], pose[3])
+    qtm_wrapper.on_cf_pose = partial(send_extpose_rot_matrix, cf)
 
     setup_estimator(cf)
 
     # FLY
-    while(fly == True):
-
-        # Land if drone strays out of bounding box
-        if not (x_min - safeZone_margin < cf_pose.x < x_max + safeZone_margin
-           and  y_min - safeZone_margin < cf_pose.y < y_max + safeZone_margin
-           and  z_min - safeZone_margin < cf_pose.z < z_max + safeZone_margin):
-            print("DRONE HAS LEFT SAFE ZONE!")
-            break
-        # Land if drone disappears
-        if cf_trackingLoss > cf_trackingLoss_treshold:
-            print("TRACKING LOST FOR " + str(cf_trackingLoss_treshold) + " FRAMES!")
-            break
-
-        # Select controller to follow
-        controller_pose = controller_poses[controller_select]
-
-        # Compute target
-        target_pose = Pose(
-            controller_pose.x + controller_offset_x,
-            controller_pose.y + controller_offset_y,
-            controller_pose.z + controller_offset_z,
-            # yaw = controller_pose.yaw
-            yaw = 0
-        )
-
-        # Keep target inside bounding box
-        target_pose.x = max(x_min, min(target_pose.x, x_max))
-        target_pose.y = max(y_min, min(target_pose.y, y_max))
-        target_pose.z = max(z_min, min(target_pose.z, z_max))
-
-        # Go to target
-        cf.commander.send_position_setpoint(target_pose.x, target_pose.y, target_pose.z, target_pose.yaw)
+    # Setpoints are sent from the QTM thread as packets arrive,
+    # here we only watch that QTM data keeps coming
+    qtm_wrapper.on_control = partial(follow_controller, cf)
+    while fly and not fly_abort.is_set():
+        fly_abort.wait(0.1)
+        if time.monotonic() - qtm_wrapper.last_packet_t > qtm_stall_timeout:
+            print("NO QTM DATA FOR " + str(qtm_stall_timeout) + " S!")
+            fly_abort.set()
+    qtm_wrapper.on_control = None
+
+    # Land on a snapshot of the controller pose; the one in controller_poses
+    # is rewritten field by field on the QTM thread
+    selected_pose = controller_poses[controller_select]
+    controller_pose = Pose(selected_pose.x, selected_pose.y, selected_pose.z)
 
     # Land calmly
     print("Landing...")
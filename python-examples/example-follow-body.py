@@ -10,7 +10,6 @@ Crazyflie lifts and hovers at the "home" position when the script is started.
 Triggering an event in QTM (while recording) toggles between states.
 """
 
-import math
 import os
 import time
 
@@ -20,7 +19,7 @@ import qtm
 from twisted.internet import threads
 import xmltodict
 
-from helpers import convert_coords_to_setpoint, crazyflie_reset_estimator, print_status
+from helpers import MM_TO_M, convert_coords_to_setpoint, crazyflie_reset_estimator, print_status
 
 # Settings
 CRAZYFLIE_URI = "radio://0/80/2M"
@@ -33,7 +32,10 @@ FOLLOW_OFFSET = [1.0, 1.0, 0.1]  # (X, Y, Z)
 
 # Initializing
 scf = None
+crazyflieSendExtpos = None
 qtmRigidbodies_idxByName = {}
+crazyflieRigidbodyIdx = None
+targetRigidbodyIdx = None
 trackingFramesLost = 0
 follow = False
 follow_position = None
@@ -57,7 +59,7 @@ def on_qtm_connect(connection, version):
 def qtm_receive_params(params):
     """Callback to handle incoming parameters from QTM"""
 
-    global qtmRigidbodies_idxByName
+    global qtmRigidbodies_idxByName, crazyflieRigidbodyIdx, targetRigidbodyIdx
 
     try:
         params = xmltodict.parse(params.decode("utf-8"))
@@ -71,6 +73,16 @@ def qtm_receive_params(params):
         print("Terminating due to error receiving QTM parameters:", str(e))
         os._exit(1)
 
+    # Check if all the bodies are there
+    for name in (CRAZYFLIE_RIGIDBODY_NAME, TARGET_RIGIDBODY_NAME):
+        if name not in qtmRigidbodies_idxByName:
+            print("Rigid body '{}' not found in QTM 6DOF bodies! Terminating.".format(name))
+            os._exit(1)
+
+    # Resolve indexes once instead of looking them up on every packet
+    crazyflieRigidbodyIdx = qtmRigidbodies_idxByName[CRAZYFLIE_RIGIDBODY_NAME]
+    targetRigidbodyIdx = qtmRigidbodies_idxByName[TARGET_RIGIDBODY_NAME]
+
 
 def on_qtm_disconnect(reason):
     """Callback to handle QTM disconnect"""
@@ -91,41 +103,44 @@ def on_qtm_event(event):
 def on_qtm_packet(packet):
     """Callback to handle QTM packets"""
 
-    global scf, \
-        CRAZYFLIE_RIGIDBODY_NAME, TARGET_RIGIDBODY_NAME, \
-        FOLLOW_OFFSET, follow_position, \
-        qtmRigidbodies_idxByName, trackingFramesLost
+    global crazyflieSendExtpos, \
+        crazyflieRigidbodyIdx, targetRigidbodyIdx, \
+        FOLLOW_OFFSET, follow_position, trackingFramesLost
 
     # Get rigidbody data from QTM
     header, bodies = packet.get_6d_euler()
 
     # Increment frame loss counter if anything is wrong
-    if not scf or not bodies:
+    if not crazyflieSendExtpos or not bodies or targetRigidbodyIdx is None:
         trackingFramesLost += 1
         return
 
     # Get positions for Crazyflie and target
-    crazyflie_rigidbody = bodies[qtmRigidbodies_idxByName[CRAZYFLIE_RIGIDBODY_NAME]]
-    target_rigidbody = bodies[qtmRigidbodies_idxByName[TARGET_RIGIDBODY_NAME]]
+    crazyflie_rigidbody = bodies[crazyflieRigidbodyIdx]
+    target_rigidbody = bodies[targetRigidbodyIdx]
 
-    # The positions returned by QTM is in 'mm' - divide by 1000 to convert to 'm'
-    cf_pos = [coord / 1000.0 for coord in crazyflie_rigidbody[0]]
-    tg_pos = [coord / 1000.0 for coord in target_rigidbody[0]]
+    cf_x, cf_y, cf_z = crazyflie_rigidbody[0]
+    tg_x, tg_y, tg_z = target_rigidbody[0]
 
     # If QTM loses tracking it may return `NaN` which can crash Crazyflie if sent
     # In case of `Nan` values, don't update positions, and increment frame loss counter
-    if any([math.isnan(coord) for coord in cf_pos]) or any([math.isnan(coord) for coord in tg_pos]):
+    # (`NaN` is the only value that is not equal to itself)
+    if cf_x != cf_x or cf_y != cf_y or cf_z != cf_z or tg_x != tg_x or tg_y != tg_y or tg_z != tg_z:
         trackingFramesLost += 1
     else:
-        scf.cf.extpos.send_extpos(*cf_pos)
-        follow_position = tuple(map(sum, zip(tg_pos, FOLLOW_OFFSET))) + (0,)  # Last element added for yaw
+        # The positions returned by QTM is in 'mm' - multiply by MM_TO_M to convert to 'm'
+        crazyflieSendExtpos(cf_x * MM_TO_M, cf_y * MM_TO_M, cf_z * MM_TO_M)
+        follow_position = (tg_x * MM_TO_M + FOLLOW_OFFSET[0],
+                           tg_y * MM_TO_M + FOLLOW_OFFSET[1],
+                           tg_z * MM_TO_M + FOLLOW_OFFSET[2],
+                           0)  # Last element added for yaw
         trackingFramesLost = 0
 
 
 def crazyflie_controller():
     """Crazyflie flight controller - initializes position estimator and calls for flight instructions"""
 
-    global scf, CRAZYFLIE_URI, follow
+    global scf, crazyflieSendExtpos, CRAZYFLIE_URI, follow
 
     follow = False
 
@@ -137,6 +152,8 @@ def crazyflie_controller():
                 print("Crazyflie is not True! Terminating.")
                 os._exit(1)
             else:
+                # Bind the method once, it is called for every QTM packet
+                crazyflieSendExtpos = scf.cf.extpos.send_extpos
                 print("Connected to Crazyflie at", CRAZYFLIE_URI, "- resetting position estimator...")
                 crazyflie_reset_estimator(scf)
                 crazyflie_fly()
@@ -161,10 +178,10 @@ def crazyflie_fly():
         # Check if tracking is good
         if trackingFramesLost <= FRAME_LOSS_THRESHOLD:
             if follow:
-                print_status("Following {} with offset ()...".format((TARGET_RIGIDBODY_NAME, FOLLOW_OFFSET)))
+                print_status("follow", "Following {} with offset ()...", (TARGET_RIGIDBODY_NAME, FOLLOW_OFFSET))
                 target = follow_position
             else:
-                print_status("Going home to ({})...".format(HOME_POSITION))
+                print_status("home", "Going home to ({})...", HOME_POSITION)
                 target = HOME_POSITION
             target = convert_coords_to_setpoint(target)
             cf.commander.send_setpoint(*target)
@@ -10,7 +10,6 @@ Crazyflie lifts and hovers at the "home" position when the script is started.
 Triggering an event in QTM (while recording) toggles between positions.
 """
 
-import math
 import os
 import time
 
@@ -20,7 +19,7 @@ import qtm
 from twisted.internet import threads
 import xmltodict
 
-from helpers import convert_coords_to_setpoint, crazyflie_reset_estimator, print_status
+from helpers import MM_TO_M, convert_coords_to_setpoint, crazyflie_reset_estimator, print_status
 
 # Settings
 CRAZYFLIE_URI = "radio://0/80/2M"
@@ -32,7 +31,9 @@ AWAY_POSITION = (0.1, 0.1, 0.5, 0.0)  # (X, Y, Z, Yaw)
 
 # Initializing
 scf = None
+crazyflieSendExtpos = None
 qtmRigidbodies_idxByName = {}
+crazyflieRigidbodyIdx = None
 trackingFramesLost = 0
 target = HOME_POSITION
 flyAway = False
@@ -57,7 +58,7 @@ def on_qtm_connect(connection, version):
 def qtm_receive_params(params):
     """Callback to handle incoming parameters from QTM"""
 
-    global qtmRigidbodies_idxByName
+    global qtmRigidbodies_idxByName, crazyflieRigidbodyIdx
 
     try:
         params = xmltodict.parse(params.decode("utf-8"))
@@ -71,6 +72,14 @@ def qtm_receive_params(params):
         print("Terminating due to error receiving QTM parameters:", str(e))
         os._exit(1)
 
+    # Check if the Crazyflie body is there
+    if CRAZYFLIE_RIGIDBODY_NAME not in qtmRigidbodies_idxByName:
+        print("Rigid body '{}' not found in QTM 6DOF bodies! Terminating.".format(CRAZYFLIE_RIGIDBODY_NAME))
+        os._exit(1)
+
+    # Resolve indexes once instead of looking them up on every packet
+    crazyflieRigidbodyIdx = qtmRigidbodies_idxByName[CRAZYFLIE_RIGIDBODY_NAME]
+
 
 def on_qtm_disconnect(reason):
     """Callback to handle QTM disconnect"""
@@ -104,37 +113,38 @@ def on_qtm_event(event):
 def on_qtm_packet(packet):
     """Callback to handle QTM packets"""
 
-    global scf, CRAZYFLIE_RIGIDBODY_NAME, qtmRigidbodies_idxByName, trackingFramesLost
+    global crazyflieSendExtpos, crazyflieRigidbodyIdx, trackingFramesLost
 
     # Get rigidbody data from QTM
     header, bodies = packet.get_6d_euler()
 
     # Increment frame loss counter if anything is wrong
-    if not scf or not bodies:
+    if not crazyflieSendExtpos or not bodies or crazyflieRigidbodyIdx is None:
         trackingFramesLost += 1
         return
 
     # Get position for Crazyflie
-    crazyflie_rigidbody = bodies[qtmRigidbodies_idxByName[CRAZYFLIE_RIGIDBODY_NAME]]
+    crazyflie_rigidbody = bodies[crazyflieRigidbodyIdx]
 
-    # The positions returned by QTM is in 'mm' - divide by 1000 to convert to 'm'
-    cf_pos = [coord / 1000.0 for coord in crazyflie_rigidbody[0]]
+    x, y, z = crazyflie_rigidbody[0]
 
-    # print("Crazyflie position: {}".format(cf_pos))
+    # print("Crazyflie position: {}".format((x, y, z)))
 
     # If QTM loses tracking it may return `NaN` which can crash Crazyflie if sent
     # In case of `Nan` values, don't send to Crazyflie, and increment frame loss counter
-    if any([math.isnan(coord) for coord in cf_pos]):
+    # (`NaN` is the only value that is not equal to itself)
+    if x != x or y != y or z != z:
         trackingFramesLost += 1
     else:
-        scf.cf.extpos.send_extpos(*cf_pos)
+        # The positions returned by QTM is in 'mm' - multiply by MM_TO_M to convert to 'm'
+        crazyflieSendExtpos(x * MM_TO_M, y * MM_TO_M, z * MM_TO_M)
         trackingFramesLost = 0
 
 
 def crazyflie_controller():
     """Crazyflie flight controller - initializes position estimator and calls for flight instructions"""
 
-    global scf, CRAZYFLIE_URI, flyAway
+    global scf, crazyflieSendExtpos, CRAZYFLIE_URI, flyAway
 
     # Reset target before liftoff for safety
     flyAway = False
@@ -147,6 +157,8 @@ def crazyflie_controller():
                 print("Crazyflie is not True! Terminating.")
                 os._exit(1)
             else:
+                # Bind the method once, it is called for every QTM packet
+                crazyflieSendExtpos = scf.cf.extpos.send_extpos
                 print("Connected to Crazyflie at", CRAZYFLIE_URI, "- resetting position estimator...")
                 crazyflie_reset_estimator(scf)
                 crazyflie_fly()
@@ -168,7 +180,7 @@ def crazyflie_fly():
         time.sleep(0.1)
         # Check if tracking is good
         if trackingFramesLost <= FRAME_LOSS_THRESHOLD:
-            print_status("Setting position {}".format(target))
+            print_status(target, "Setting position {}", target)
             setpoint = convert_coords_to_setpoint(target)
             cf.commander.send_setpoint(*setpoint)
         else:
@@ -4,10 +4,14 @@
 """
 
 import time
+from collections import deque
 
 from cflib.crazyflie.log import LogConfig
 from cflib.crazyflie.syncLogger import SyncLogger
 
+# QTM reports positions in mm
+MM_TO_M = 0.001
+
 lastStatusMessage = ""
 
 
@@ -34,9 +38,9 @@ def crazyflie_reset_estimator(scf):
     log_config.add_variable('kalman.varPY', 'float')
     log_config.add_variable('kalman.varPZ', 'float')
 
-    var_y_history = [1000] * 10
-    var_x_history = [1000] * 10
-    var_z_history = [1000] * 10
+    var_y_history = deque([1000] * 10, maxlen=10)
+    var_x_history = deque([1000] * 10, maxlen=10)
+    var_z_history = deque([1000] * 10, maxlen=10)
 
     threshold = 0.001
 
@@ -45,11 +49,8 @@ def crazyflie_reset_estimator(scf):
             data = log_entry[1]
 
             var_x_history.append(data['kalman.varPX'])
-            var_x_history.pop(0)
             var_y_history.append(data['kalman.varPY'])
-            var_y_history.pop(0)
             var_z_history.append(data['kalman.varPZ'])
-            var_z_history.pop(0)
 
             min_x = min(var_x_history)
             max_x = max(var_x_history)
@@ -68,11 +69,15 @@ def crazyflie_reset_estimator(scf):
                 break
 
 
-def print_status(message):
-    """Prints status messages to console, but only if something new has happened"""
+def print_status(key, message=None, *args):
+    """Prints status messages to console, but only if something new has happened
+
+    `key` identifies the status. The message is only formatted with `args` when
+    the key changes; without a message the key itself is printed.
+    """
 
     global lastStatusMessage
 
-    if lastStatusMessage != message:
-        print(message)
-        lastStatusMessage = message
+    if lastStatusMessage != key:
+        print(key if message is None else message.format(*args))
+        lastStatusMessage = key